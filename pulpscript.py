@@ -2,28 +2,37 @@
 # It's more complicated than transpiling the assets, so it gets its own file
 # to keep it self-contained.
 
+import functools
+import math
 import re
 
 RELASSIGN = True # allow relative assignment in lua, e.g. `x += 1`
 
+_ID_RE = re.compile(r'[a-zA-Z_]\w*\Z')
+
 def is_id(varname):
-    return re.match(r'^[a-zA-Z_]\w*$', varname) is not None
+    return _ID_RE.match(varname) is not None
 
+@functools.lru_cache(maxsize=8192)
 def sanitize_varname(varname):
     if is_id(varname):
         return varname
     varname = varname.replace('"', '\\"')
     return f"_G[\"{varname}\"]"
 
+_SCRIPT_TAG_TABLE = str.maketrans("- ", "__")
+
 class PulpScriptContext:
     def __init__(self):
         self.indent = 1
+        self._indents = tuple("  "*i for i in range(32))
         self.errors = []
         self.vars = set()
         self.var_usage = {}
         self.full_mimics = []
         
         # cache these at the start of each function
+        # (each entry is a dict used as an insertion-ordered set)
         self.funccache = []
         
         self.evobjs = []
@@ -36,10 +45,10 @@ class PulpScriptContext:
         self.script_tags = dict()
         
     def push_funccache(self):
-        self.funccache.append(set())
+        self.funccache.append(dict())
         
     def add_script_tag(self, scriptsrc, name):
-        san_name = "__OPTTAG__" + (scriptsrc + "_" + name).replace("-", "_").replace(" ", "_")
+        san_name = "__OPTTAG__" + (scriptsrc + "_" + name).translate(_SCRIPT_TAG_TABLE)
         if san_name in self.script_tags:
             return san_name
         
@@ -50,7 +59,7 @@ class PulpScriptContext:
         return san_name
     
     def pop_funccache(self):
-        self.funccache = self.funccache[:-1]
+        self.funccache.pop()
     
     def get_funccache(self):
         return self.funccache[-1]
@@ -59,7 +68,7 @@ class PulpScriptContext:
         self.evobjs.append(obj)
     
     def pop_evobj(self):
-        self.evobjs = self.evobjs[:-1]
+        self.evobjs.pop()
     
     def get_evobj(self):
         return self.evobjs[-1]
@@ -87,7 +96,11 @@ class PulpScriptContext:
         
     # get-indent.
     def gi(self):
-        return "  "*self.indent
+        try:
+            return self._indents[self.indent]
+        except IndexError:
+            self._indents = tuple("  "*i for i in range(self.indent * 2))
+            return self._indents[self.indent]
         
     def commentconfigure(self, mode, conf):
         key, value = conf.split("=")
@@ -109,7 +122,7 @@ compdict = {
     "neq": "~=",
 }
 
-funclist = [
+funclist = frozenset([
     "goto",
     "shake",
     "fin",
@@ -143,10 +156,10 @@ funclist = [
     "window",
     "crop",
     "play",
-]
+])
 
 # functions which can be used in expressions
-exfuncs = [
+exfuncs = frozenset([
     "type",
     "id",
     "solid",
@@ -164,7 +177,7 @@ exfuncs = [
     "radians",
     "lpad", # args: (string, width, [padsymbol])
     "rpad", # args: (string, width, [padsymbol])
-]
+])
 
 inlinefuncs = {
     "__fn_frame": "{0}.frame = {1}",
@@ -180,6 +193,34 @@ inlinefuncs = {
     "__ex_radians": "({0} * __tau / 360)",
 }
 
+_PLACEHOLDER_RE = re.compile(r'\{(\d+)\}')
+
+# compiles an inline template into a function which fills in its {N} placeholders in one pass.
+# placeholders without a matching argument are left as-is.
+def compile_template(template):
+    pieces = _PLACEHOLDER_RE.split(template)
+    literals = pieces[0::2]
+    indices = [int(i) for i in pieces[1::2]]
+    
+    def apply(args):
+        parts = [literals[0]]
+        for idx, literal in zip(indices, literals[1:]):
+            parts.append(args[idx] if idx < len(args) else "{" + str(idx) + "}")
+            parts.append(literal)
+        return "".join(parts)
+    return apply
+
+inlineformatters = {name: compile_template(template) for name, template in inlinefuncs.items()}
+
+# pure inline functions which are evaluated at compile-time if all their arguments are numeric literals.
+# maps to (number of arguments, python implementation)
+foldfuncs = {
+    "__ex_degrees": (1, lambda x: x * 360 / math.tau),
+    "__ex_radians": (1, lambda x: x * math.tau / 360),
+}
+
+_NUMBER_RE = re.compile(r'-?\d+(\.\d*)?([eE][-+]?\d+)?\Z')
+
 # specifies the order of the *first* arguments to these functions.
 # additional arguments may follow!
 funcargs = {
@@ -215,16 +256,20 @@ staticfuncs = {
     "random": "__random",
 }
 
+_ESCAPE_TABLE = str.maketrans({
+    "\\": "\\\\",
+    "\n": "\\n",
+    "\f": "\\f",
+    "\"": "\\\"",
+})
+
 # adds backslashes
 def escape_string(s):
-    return s.replace("\\","\\\\") \
-        .replace("\n", "\\n") \
-        .replace("\f", "\\f") \
-        .replace("\"", "\\\"")
+    return s.translate(_ESCAPE_TABLE)
 
 # note that '.' is valid in a token, but not an id
 def istoken(s):
-    if type(s) != str:
+    if type(s) is not str:
         return False
     if " " in s:
         return False
@@ -240,7 +285,7 @@ tile_ids = dict() # populated in pulplua.py
 
 def optimize_name_ref(cmd, idx):
     if len(cmd) > idx:
-        if type(cmd[idx]) == str and cmd[idx] in tile_ids:
+        if type(cmd[idx]) is str and cmd[idx] in tile_ids:
             cmd[idx] = [
                 "optimized-id",
                 tile_ids[cmd[idx]],
@@ -249,96 +294,65 @@ def optimize_name_ref(cmd, idx):
             return True
     return False
     
+# special variables which require special caching behaviour per-function.
+# maps to (lua expression, funccache line)
+# note that they cannot be set (op_set), so we don't need to consider them there.
+_SPECIAL_CACHED = {
+    "event.px": ("__event_px", "local __event_px = __pulp.player.x"),
+    "event.py": ("__event_py", "local __event_py = __pulp.player.y"),
+    "event.x": ("__event_x", "local __event_x = __actor.x or __pulp.player.x"),
+    "event.y": ("__event_y", "local __event_y = __actor.y or __pulp.player.y"),
+    "event.dx": ("__event_dx", "local __event_dx = event.dx or 0"),
+    "event.dy": ("__event_dy", "local __event_dy = event.dy or 0"),
+    "event.tile": ("__event_tile", "local __event_tile = __actor.name or 0"),
+}
+
+# special variables which are remapped to another lua expression.
+_SPECIAL_PASSTHROUGH = {
+    "event.room": "event.room.name",
+    "event.player": "__pulp.player.name",
+    "datetime.year": "__getTime().year",
+    "datetime.year99": "--[[(year99)]] (__getTime().year % 100)",
+    "datetime.month": "__getTime().month",
+    "datetime.day": "__getTime().day",
+    "datetime.weekday": "(__getTime().weekday - 1)",
+    "datetime.hour": "__getTime().hour",
+    "datetime.hour12": "--[[(hour12)]] ((__getTime().hour % 12) + 1)",
+    "datetime.minute": "__getTime().minute",
+    "datetime.second": "__getTime().second",
+    "datetime.millisecond": "__getTime().millisecond --[[(PTL-only?)]]", #note: pulp-to-lua extension
+    "datetime.ampm": "--[[(ampm)]] (__getTime().hour < 12 and \"am\" or \"pm\")",
+    "datetime.AMPM": "--[[(AMPM)]] (__getTime().hour < 12 and \"AM\" or \"PM\")  --[[(PTL-only?)]]", #note: pulp-to-lua extension
+    "datetime.timestamp": "__getSecondsSinceEpoch()",
+    "__PTLE_SMOOTH_MOVEMENT_SPEED": "__pulp.PTLE_SMOOTH_MOVEMENT_SPEED",
+    "__PTLE_SMOOTH_OFFSET_X": "__pulp.PTLE_SMOOTH_OFFSET_X",
+    "__PTLE_SMOOTH_OFFSET_Y": "__pulp.PTLE_SMOOTH_OFFSET_Y",
+    "__PTLE_CONFIRM_DAS": "__pulp.PTLE_CONFIRM_DAS",
+    "__PTLE_CANCEL_DAS": "__pulp.PTLE_CANCEL_DAS",
+    "__PTLE_V_DAS": "__pulp.PTLE_V_DAS",
+    "__PTLE_H_DAS": "__pulp.PTLE_H_DAS",
+}
+
 def remap_special_varname(varname, ctx):
-    # these require special caching behaviour per-function
-    # note that they cannot be set (op_set), so we don't need to consider them there.
-    if varname == "event.px":
-        ctx.get_funccache().add("local __event_px = __pulp.player.x")
-        return "__event_px"
-    elif varname == "event.py":
-        ctx.get_funccache().add("local __event_py = __pulp.player.y")
-        return "__event_py"
-    elif varname == "event.x":
-        ctx.get_funccache().add("local __event_x = __actor.x or __pulp.player.x")
-        return "__event_x"
-    elif varname == "event.y":
-        ctx.get_funccache().add("local __event_y = __actor.y or __pulp.player.y")
-        return "__event_y"
-    elif varname == "event.dx":
-        ctx.get_funccache().add("local __event_dx = event.dx or 0")
-        return "__event_dx"
-    elif varname == "event.dy":
-        ctx.get_funccache().add("local __event_dy = event.dy or 0")
-        return "__event_dy"
-    elif varname == "event.tile":
-        ctx.get_funccache().add("local __event_tile = __actor.name or 0")
-        return "__event_tile"
-    elif varname == "event.room":
-        return "event.room.name"
-    elif varname == "event.player":
-        return "__pulp.player.name"
-    elif varname == "datetime.year":
-        return "__getTime().year"
-    elif varname == "datetime.year99":
-        return "--[[(year99)]] (__getTime().year % 100)"
-    elif varname == "datetime.month":
-        return "__getTime().month"
-    elif varname == "datetime.day":
-        return "__getTime().day"
-    elif varname == "datetime.weekday":
-        return "(__getTime().weekday - 1)"
-    elif varname == "datetime.day":
-        return "__getTime().day"
-    elif varname == "datetime.hour":
-        return "__getTime().hour"
-    elif varname == "datetime.hour12":
-        return "--[[(hour12)]] ((__getTime().hour % 12) + 1)"
-    elif varname == "datetime.minute":
-        return "__getTime().minute"
-    elif varname == "datetime.second":
-        return "__getTime().second"
-    elif varname == "datetime.millisecond": #note: pulp-to-lua extension
-        return "__getTime().millisecond --[[(PTL-only?)]]"
-    elif varname == "datetime.ampm":
-        return "--[[(ampm)]] (__getTime().hour < 12 and \"am\" or \"pm\")"
-    elif varname == "datetime.AMPM": #note: pulp-to-lua extension
-        return "--[[(AMPM)]] (__getTime().hour < 12 and \"AM\" or \"PM\")  --[[(PTL-only?)]]"
-    elif varname == "datetime.timestamp":
-        return "__getSecondsSinceEpoch()"
-    elif varname == "__PTLE_SMOOTH_MOVEMENT_SPEED":
-        return "__pulp.PTLE_SMOOTH_MOVEMENT_SPEED"
-    elif varname == "__PTLE_SMOOTH_OFFSET_X":
-        return "__pulp.PTLE_SMOOTH_OFFSET_X"
-    elif varname == "__PTLE_SMOOTH_OFFSET_Y":
-        return "__pulp.PTLE_SMOOTH_OFFSET_Y"
-    elif varname == "__PTLE_CONFIRM_DAS":
-        return "__pulp.PTLE_CONFIRM_DAS"
-    elif varname == "__PTLE_CANCEL_DAS":
-        return "__pulp.PTLE_CANCEL_DAS"
-    elif varname == "__PTLE_V_DAS":
-        return "__pulp.PTLE_V_DAS"
-    elif varname == "__PTLE_H_DAS":
-        return "__pulp.PTLE_H_DAS"
-    
-    return varname
+    hit = _SPECIAL_CACHED.get(varname)
+    if hit is not None:
+        ctx.get_funccache()[hit[1]] = None
+        return hit[0]
+    return _SPECIAL_PASSTHROUGH.get(varname, varname)
 
 def ex_get(expression, ctx):
     return remap_special_varname(ctx.pingvar(expression[1]), ctx)
     
     
 def ex_format(expression, ctx):
-    s = ""
-    first = True
+    parts = []
     for component in expression[1:]:
-        if not first:
-            s += " .. "
-        first = False
         if type(component) is str:
-            s += decode_rvalue(component, ctx)
+            parts.append(decode_rvalue(component, ctx))
         else:
-            s += "__tostring(" + decode_rvalue(component, ctx) + ")"
+            parts.append("__tostring(" + decode_rvalue(component, ctx) + ")")
             
-    return s
+    return " .. ".join(parts)
 
 def ex_embed(expression, ctx):
     return f"__pulp.__ex_embed({decode_rvalue(expression[1], ctx)})"
@@ -351,7 +365,7 @@ def ex_subroutine(expression, ctx):
     return s + ctx.gi() + "  end"
     
 def ex_name(expression, ctx):
-    if type(expression[1]) == list and expression[1][0] == "xy":
+    if type(expression[1]) is list and expression[1][0] == "xy":
         x = decode_rvalue(expression[1][1], ctx)
         y = decode_rvalue(expression[1][2], ctx)
         #return f"(((__roomtiles[{y}] or __pulp.EMPTY)[{x}] or __pulp.EMPTY).tile or __pulp.EMPTY).name or \"\""
@@ -359,43 +373,90 @@ def ex_name(expression, ctx):
     else:
         return opex_func(expression, "name", "__ex_", ctx)
 
+# decoded literals depend only on the literal itself, so they are cached across calls.
+# the caches are bounded; the oldest entry is evicted first.
+LITERAL_CACHE_MAX = 4096
+_STR_CACHE = {}
+_INT_CACHE = {}
+
+def _cache_literal(cache, key, value):
+    if len(cache) >= LITERAL_CACHE_MAX:
+        del cache[next(iter(cache))]
+    cache[key] = value
+    return value
+
+_OPTID_CACHE = {}
+
+def ex_optimized_id(expression, ctx):
+    key = (expression[1], expression[2])
+    s = _OPTID_CACHE.get(key)
+    if s is None:
+        s = _cache_literal(_OPTID_CACHE, key, f"--[[({expression[2]})]] "+str(expression[1]))
+    return s
+
+_RVALUE_DISPATCH = {
+    "get": ex_get,
+    "optimized-id": ex_optimized_id,
+    "format": ex_format,
+    "embed": ex_embed,
+    "name": ex_name,
+    "block": ex_subroutine,
+}
+
+def decode_expression(expression, ctx):
+    ex = expression[0]
+    handler = _RVALUE_DISPATCH.get(ex)
+    if handler is not None:
+        return handler(expression, ctx)
+    elif ex in exfuncs:
+        return opex_func(expression, ex, "__ex_", ctx)
+    else:
+        ctx.errors += ["unknown expression code: " + ex]
+        return f"nil --[[unknown expression code '{ex}']]"
+
 def decode_rvalue(expression, ctx):
-    if type(expression) == str:
-        return '"' + escape_string(str(expression)) + '"'
-    elif type(expression) == int or type(expression) == float:
+    # expressions are the most common case, so they are checked first.
+    t = type(expression)
+    if t is list:
+        return decode_expression(expression, ctx)
+    elif t is str:
+        s = _STR_CACHE.get(expression)
+        if s is None:
+            s = _cache_literal(_STR_CACHE, expression, '"' + escape_string(expression) + '"')
+        return s
+    elif t is int:
+        s = _INT_CACHE.get(expression)
+        if s is None:
+            s = _cache_literal(_INT_CACHE, expression, str(expression))
+        return s
+    elif t is float:
         return str(expression)
     elif expression is None:
         return "nil"
     else:
-        ex = expression[0]
-        if ex == "get":
-            return ex_get(expression, ctx)
-        elif ex == "optimized-id":
-            return f"--[[({expression[2]})]] "+str(expression[1])
-        elif ex == "format":
-            return ex_format(expression, ctx)
-        elif ex == "embed":
-            return ex_embed(expression, ctx)
-        elif ex == "name":
-            return ex_name(expression, ctx)
-        elif ex in exfuncs:
-            return opex_func(expression, ex, "__ex_", ctx)
-        elif ex == "block":
-            return ex_subroutine(expression, ctx)
-        else:
-            ctx.errors += ["unknown expression code: " + ex]
-            return f"nil --[[unknown expression code '{ex}']]"
+        return decode_expression(expression, ctx)
 
-def op_set(cmd, operator, ctx):
+def _op_set_operands(cmd, ctx):
     lvalue = cmd[1]
-    assert (type(lvalue) == str)
+    assert (type(lvalue) is str)
     lvalue = ctx.pingvar(lvalue)
     rvalue = decode_rvalue(cmd[2], ctx)
-    if operator == "" or RELASSIGN:
-        return f"{lvalue} {operator}= {rvalue}"
+    return lvalue, rvalue
+
+def _op_set_rel(cmd, operator, ctx):
+    lvalue, rvalue = _op_set_operands(cmd, ctx)
+    return f"{lvalue} {operator}= {rvalue}"
+
+def _op_set_full(cmd, operator, ctx):
+    lvalue, rvalue = _op_set_operands(cmd, ctx)
+    if operator == "":
+        return f"{lvalue} = {rvalue}"
     else:
         return f"{lvalue} = {lvalue} {operator} {rvalue}"
 
+# RELASSIGN is constant, so the assignment style is chosen once here.
+op_set = _op_set_rel if RELASSIGN else _op_set_full
+
 def op_block(cmd, statement, follow, end, ctx):
     condition = cmd[1]
     comparison = condition[0]
@@ -409,43 +470,46 @@ def op_block(cmd, statement, follow, end, ctx):
     compr = decode_rvalue(condition[2], ctx)
     block = cmd[2]
     assert(block[0] == "block")
-    s = f"{statement} {compl} {compsym} {compr} {follow}\n"
+    gi = ctx.gi()
+    parts = [f"{statement} {compl} {compsym} {compr} {follow}\n"]
     ctx.indent += 1
-    s += transpile_commands(ctx.blocks[block[1]], ctx)
+    parts.append(transpile_commands(ctx.blocks[block[1]], ctx))
     ctx.indent -= 1
     
     for sub in cmd[3:]:
         if sub[0] == "elseif":
-            s += ctx.gi() + op_block(sub, "elseif", "then", None, ctx)
+            parts.append(gi)
+            parts.append(op_block(sub, "elseif", "then", None, ctx))
         elif sub[0] == "else":
-            s += ctx.gi() + "else\n"
+            parts.append(gi + "else\n")
             ctx.indent += 1
             block = sub[1]
             assert(block[0] == "block")
-            s += transpile_commands(ctx.blocks[block[1]], ctx)
+            parts.append(transpile_commands(ctx.blocks[block[1]], ctx))
             ctx.indent -= 1
             pass
         else:
             assert False, f"unrecognized block followup '{sub[0]}'"
     if end:
-        s += ctx.gi() + end
-    return s
+        parts.append(gi + end)
+    return "".join(parts)
 
 def op_call(cmd, ctx, tags):
     global EVNAMECOUNTER
     
     # NOTE: it's important that we use '__self' here, as *mimic* calls do not call back virtually to the original
     # actor's script.
-    # ctx.get_funccache().add(f"local __evobj = {ctx.get_evobj()}")
+    # ctx.get_funccache()[f"local __evobj = {ctx.get_evobj()}"] = None
     
+    evobj = ctx.get_evobj()
     if istoken(cmd[1]):
         fnstr = f"\"{cmd[1]}\""
-        callfn = f"{ctx.get_evobj()}.{cmd[1]}"
+        callfn = f"{evobj}.{cmd[1]}"
     else:
         fnstr = decode_rvalue(cmd[1], ctx)
-        callfn = f"{ctx.get_evobj()}[{fnstr}]"
+        callfn = f"{evobj}[{fnstr}]"
         
-    fnbase = f";({callfn} or {ctx.get_evobj()}.any)"
+    fnbase = f";({callfn} or {evobj}.any)"
     
     comment = f"--[call \"{fnstr[1:-1]}\"]"
     
@@ -455,12 +519,12 @@ def op_call(cmd, ctx, tags):
         comment += " [DIRECT]"
             
     
-    if ctx.get_evobj() == "__self":
-        ctx.get_funccache().add(f"local __self = {ctx.root_evobj} --[this script]")
+    if evobj == "__self":
+        ctx.get_funccache()[f"local __self = {ctx.root_evobj} --[this script]"] = None
         
         # simplification if we know the name of the function
         if istoken(cmd[1]):
-            if cmd[1] in list(ctx.self_evnames):
+            if cmd[1] in ctx.self_evnames:
                 fnbase = callfn
                 comment = ""
             else:
@@ -479,59 +543,67 @@ def op_emit(cmd, ctx):
     return f"__pulp:emit({decode_rvalue(cmd[1], ctx)}, event)"
     
 def op_mimic(cmd, ctx):
-    if optimize_name_ref(cmd, 1) or type(cmd[1]) == int:
+    if optimize_name_ref(cmd, 1) or type(cmd[1]) is int:
         s = f"do -- (mimic)\n"
+        outer = ctx.gi()
         ctx.indent += 1
-        s += ctx.gi() + f"local __mimic_target__ = (__pulp.tiles[{decode_rvalue(cmd[1], ctx)}] or __pulp.EMPTY).script;\n"
-        s += ctx.gi() + "(__mimic_target__[__evname] or __mimic_target__.any)(__actor, event, __evname)\n"
+        gi = ctx.gi()
+        s += gi + f"local __mimic_target__ = (__pulp.tiles[{decode_rvalue(cmd[1], ctx)}] or __pulp.EMPTY).script;\n"
+        s += gi + "(__mimic_target__[__evname] or __mimic_target__.any)(__actor, event, __evname)\n"
         ctx.indent -= 1
-        s += ctx.gi() + "end"
+        s += outer + "end"
         return s
     else:
         s = "do -- (mimic)\n"
+        outer = ctx.gi()
         ctx.indent += 1
-        s += ctx.gi() + f"local __mimic_target__ = __pulp:getScript({decode_rvalue(cmd[1], ctx)}) or __pulp.EMPTY;\n"
-        s += ctx.gi() + f"(__mimic_target__[__evname] or __mimic_target__.any)(__actor, event, __evname)\n"
+        gi = ctx.gi()
+        s += gi + f"local __mimic_target__ = __pulp:getScript({decode_rvalue(cmd[1], ctx)}) or __pulp.EMPTY;\n"
+        s += gi + f"(__mimic_target__[__evname] or __mimic_target__.any)(__actor, event, __evname)\n"
         ctx.indent -= 1
-        s += ctx.gi() + "end"
+        s += outer + "end"
         return s
     
 def op_tell(cmd, ctx):
-    if type(cmd[1]) == list and cmd[1][0] == "xy":
+    if type(cmd[1]) is list and cmd[1][0] == "xy":
         # inline version of 'tell x,y to'
         s = "do --[tell x,y to]\n"
+        outer = ctx.gi()
         ctx.indent += 1
+        gi = ctx.gi()
         assert cmd[2][0] == "block"
-        s += ctx.gi() + f"local __actor = __roomtiles[{decode_rvalue(cmd[1][2], ctx)}][{decode_rvalue(cmd[1][1], ctx)}]\n"
-        s += ctx.gi() + f"if __actor and __actor.tile then\n"
+        s += gi + f"local __actor = __roomtiles[{decode_rvalue(cmd[1][2], ctx)}][{decode_rvalue(cmd[1][1], ctx)}]\n"
+        s += gi + f"if __actor and __actor.tile then\n"
         ctx.indent += 1
         ctx.push_evobj("__actor.script")
         assert ctx.get_evobj() != "__self"
         s += transpile_commands(ctx.blocks[cmd[2][1]], ctx, True)
         ctx.pop_evobj()
         ctx.indent -= 1
-        s += ctx.gi() + f"end\n"
+        s += gi + f"end\n"
         ctx.indent -= 1
-        s += ctx.gi() + "end\n"
+        s += outer + "end\n"
         return s
-    elif type(cmd[1]) == list and cmd[1][0] == "get" and cmd[1][1] in ["event.room", "event.game", "event.player"]:
+    elif type(cmd[1]) is list and cmd[1][0] == "get" and cmd[1][1] in ["event.room", "event.game", "event.player"]:
         # inline version of 'tell event.X to'
         target = cmd[1][1]
         if target == "event.player":
             target = "__pulp.player"
         s = f"do --[tell {target} to]\n"
+        outer = ctx.gi()
         ctx.indent += 1
+        gi = ctx.gi()
         assert cmd[2][0] == "block"
-        s += ctx.gi() + f"local __actor = {target}\n"
-        s += ctx.gi() + f"if __actor then\n"
+        s += gi + f"local __actor = {target}\n"
+        s += gi + f"if __actor then\n"
         ctx.indent += 1
         ctx.push_evobj("__actor.script")
         s += transpile_commands(ctx.blocks[cmd[2][1]], ctx, True)
         ctx.pop_evobj()
         ctx.indent -= 1
-        s += ctx.gi() + f"end\n"
+        s += gi + f"end\n"
         ctx.indent -= 1
-        s += ctx.gi() + "end\n"
+        s += outer + "end\n"
         return s
     else:
         optimize_name_ref(cmd, 1)
@@ -549,7 +621,7 @@ def opex_func(cmd, op, prefix, ctx):
     }
         
     for arg in cmd[1:]:
-        if type(arg) == list:
+        if type(arg) is list:
             if arg[0] == "xy":
                 setargs["x"] = decode_rvalue(arg[1], ctx)
                 setargs["y"] = decode_rvalue(arg[2], ctx)
@@ -567,30 +639,29 @@ def opex_func(cmd, op, prefix, ctx):
         else:
             mainargs.append(decode_rvalue(arg, ctx))
     
-    if op in funcargs:
-        for argname in funcargs[op][::-1]:
-            if argname in setargs:
-                mainargs = [setargs[argname]] + mainargs
-            else:
-                mainargs = ["nil"] + mainargs
-    
-    if prefix + op in inlinefuncs:
-        s = inlinefuncs[prefix + op]
-        for i in range(len(mainargs)):
-            s = s.replace("{" + str(i) + "}", mainargs[i])
-        return s
-    elif op in staticfuncs:
-        s = staticfuncs[op] + "("
+    argorder = funcargs.get(op)
+    if argorder is not None:
+        mainargs = [setargs.get(argname, "nil") for argname in argorder] + mainargs
+    
+    fnname = prefix + op
+    fold = foldfuncs.get(fnname)
+    if fold is not None:
+        argc, fn = fold
+        if len(mainargs) == argc and all(_NUMBER_RE.match(arg) for arg in mainargs):
+            value = fn(*[float(arg) for arg in mainargs])
+            if math.isfinite(value):
+                return f"({value!r})"
+    
+    formatter = inlineformatters.get(fnname)
+    if formatter is not None:
+        return formatter(mainargs)
+    
+    staticfn = staticfuncs.get(op)
+    if staticfn is not None:
+        s = staticfn + "("
     else:
-        s = f"__pulp.{prefix}{op}("
-    first = True
-    for arg in mainargs:
-        if first:
-            first = False
-        else:
-            s += ", "
-        s += arg
-    return s + ")"
+        s = f"__pulp.{fnname}("
+    return s + ", ".join(mainargs) + ")"
 
 def op_inc(cmd, operator, ctx):
     return cmd[1] + operator
@@ -638,78 +709,88 @@ def comment(cmd, prevline, ctx):
         
     return s
         
-def get_next_cmds_tags(ctx, cmds):
+# returns, for each command, the tags of the comments which follow it
+# (up to the next non-command entry), computed in a single backward pass.
+def get_cmds_tags(ctx, cmds):
+    tags_per_cmd = [None] * len(cmds)
     tags = []
-    for cmd in cmds:
-        if type(cmd) == list:
+    for i in range(len(cmds) - 1, -1, -1):
+        tags_per_cmd[i] = tags
+        cmd = cmds[i]
+        if type(cmd) is list:
             if cmd[0] in ["#", "#$"]:
                 idx = cmd[1]
                 if idx < len(ctx.comments_block):
                     comment = ctx.comments_block[idx].strip()
                     if comment.startswith("["):
-                        tags.append(comment)
+                        tags = [comment] + tags
         else:
-            break
-    return tags
+            tags = []
+    return tags_per_cmd
+
+# operator applied by op_set for each assignment command
+_SET_OPERATORS = {
+    "set": "",
+    "add": "+",
+    "sub": "-",
+    "div": "/",
+    "mul": "*",
+}
 
-def transpile_command(cmd, ctx, next_cmds):
+def _cmd_set(cmd, ctx, tags):
+    return op_set(cmd, _SET_OPERATORS[cmd[0]], ctx)
+
+# each handler returns the command's code without indentation or trailing newline.
+_CMD_DISPATCH = {
+    "done": lambda cmd, ctx, tags: "do return end",
+    "set": _cmd_set,
+    "add": _cmd_set,
+    "sub": _cmd_set,
+    "div": _cmd_set,
+    "mul": _cmd_set,
+    "inc": lambda cmd, ctx, tags: op_inc(cmd, "+=1", ctx),
+    "dec": lambda cmd, ctx, tags: op_inc(cmd, "-=1", ctx),
+    "random": lambda cmd, ctx, tags: op_random(cmd, ctx),
+    "if": lambda cmd, ctx, tags: op_block(cmd, "if", "then", "end", ctx),
+    "while": lambda cmd, ctx, tags: op_block(cmd, "while", "do", "end", ctx),
+    "call": lambda cmd, ctx, tags: op_call(cmd, ctx, tags),
+    "emit": lambda cmd, ctx, tags: op_emit(cmd, ctx),
+    "mimic": lambda cmd, ctx, tags: op_mimic(cmd, ctx),
+    "tell": lambda cmd, ctx, tags: op_tell(cmd, ctx),
+    "#": lambda cmd, ctx, tags: comment(cmd, False, ctx),
+    "#$": lambda cmd, ctx, tags: comment(cmd, True, ctx),
+}
+
+def transpile_command(cmd, ctx, tags):
     op = cmd[0]
     
-    tags = get_next_cmds_tags(ctx, next_cmds)
-    
     if op == "_":
         return "" # ctx.gi() + "\n"
-    elif op == "done":
-        return ctx.gi() + "do return end\n"
-    elif op == "set":
-        return ctx.gi() + op_set(cmd, "", ctx) + "\n"
-    elif op == "add":
-        return ctx.gi() + op_set(cmd, "+", ctx) + "\n"
-    elif op == "sub":
-        return ctx.gi() + op_set(cmd, "-", ctx) + "\n"
-    elif op == "div":
-        return ctx.gi() + op_set(cmd, "/", ctx) + "\n"
-    elif op == "mul":
-        return ctx.gi() + op_set(cmd, "*", ctx) + "\n"
-    elif op == "inc":
-        return ctx.gi() + op_inc(cmd, "+=1", ctx) + "\n"
-    elif op == "dec":
-        return ctx.gi() + op_inc(cmd, "-=1", ctx) + "\n"
-    elif op == "random":
-        return ctx.gi() + op_random(cmd, ctx) + "\n"
-    elif op == "if":
-        return ctx.gi() + op_block(cmd, "if", "then", "end", ctx) + "\n"
-    elif op == "while":
-        return ctx.gi() + op_block(cmd, "while", "do", "end", ctx) + "\n"
-    elif op == "call":
-        return ctx.gi() + op_call(cmd, ctx, tags) + "\n"
-    elif op == "emit":
-        return ctx.gi() + op_emit(cmd, ctx) + "\n"
-    elif op == "mimic":
-        return ctx.gi() + op_mimic(cmd, ctx) + "\n"
-    elif op == "tell":
-        return ctx.gi() + op_tell(cmd, ctx) + "\n"
+    gi = ctx.gi()
+    handler = _CMD_DISPATCH.get(op)
+    if handler is not None:
+        return gi + handler(cmd, ctx, tags) + "\n"
     elif op in funclist:
-        return ctx.gi() + opex_func(cmd, op, "__fn_", ctx) + "\n"
-    elif op in ["#", "#$"]:
-        return ctx.gi() + comment(cmd, op == "#$", ctx) + "\n"
+        return gi + opex_func(cmd, op, "__fn_", ctx) + "\n"
     else:
         ctx.errors += ["unknown command code: " + op]
-        return ctx.gi() + f"--unknown command code '{op}'\n"
+        return gi + f"--unknown command code '{op}'\n"
 
 def transpile_commands(commands, ctx, has_funccache=False):
     if has_funccache:
         ctx.push_funccache()
-    s = ""
-    for i in range(len(commands)):
-        command = commands[i]
-        if type(command) == list:
-            s += transpile_command(command, ctx, commands[i+1:])
+    parts = []
+    tags_per_cmd = get_cmds_tags(ctx, commands)
+    for i, command in enumerate(commands):
+        if type(command) is list:
+            parts.append(transpile_command(command, ctx, tags_per_cmd[i]))
     if has_funccache:
-        for cached in sorted(list(ctx.get_funccache())):
-            s = ctx.gi() + cached + "\n" + s
+        gi = ctx.gi()
+        # cached lines are emitted in the order they were first used, ahead of the body.
+        cachelines = [gi + cached + "\n" for cached in ctx.get_funccache()]
+        parts = cachelines + parts
         ctx.pop_funccache()
-    return s
+    return "".join(parts)
         
 def transpile_event(evobj, evname, ctx, blockidx, evobjname, comments_block, evnames):
     _evobj = f"__pulp:getScript(\"{evobj}\")" # evobjname would be faster, but less clear.
@@ -720,22 +801,22 @@ def transpile_event(evobj, evname, ctx, blockidx, evobjname, comments_block, evn
     
     block = ctx.blocks[blockidx]
     
-    ctx.self_evnames = evnames
+    ctx.self_evnames = frozenset(evnames)
     ctx.comments_block = comments_block
     ctx.push_evobj("__self")
     ctx.root_evobj = evobjname if evobjname else _evobj
-    cmdstr = transpile_commands(ctx.blocks[blockidx], ctx, True)
+    cmdstr = transpile_commands(block, ctx, True)
     ctx.pop_evobj()
     
     s += cmdstr
     s += "end\n"
     
     #optimization for one-line-only mimics
-    undecorated_block = list(filter(lambda x: type(x) == list and x[0] not in ["_", "#", "#$"], block))
+    undecorated_block = list(filter(lambda x: type(x) is list and x[0] not in ["_", "#", "#$"], block))
     if len(undecorated_block) == 1 and undecorated_block[0][0] == "mimic":
         mimic = undecorated_block[0]
         # TODO: if int instead of optimized-id
-        if type(mimic[1]) == list and mimic[1][0] == "optimized-id":
+        if type(mimic[1]) is list and mimic[1][0] == "optimized-id":
             mimic[1][2]
             ctx.full_mimics.append((evobj, evname, mimic[1][2]))
     return s
\ No newline at end of file